@@ -1,11 +1,20 @@
 import os
+import atexit
+import re
+import html
+import http.client
+import functools
 import time
 import requests
-import validators
-from bs4 import BeautifulSoup
+from collections import OrderedDict
+from multiprocessing.util import Finalize
+from concurrent.futures import ProcessPoolExecutor
+from bs4 import BeautifulSoup, SoupStrainer
+from lxml import html as lxml_html
+from lxml.etree import ParserError
 from selenium import webdriver
 from urllib.parse import quote
-from urllib.parse import urljoin, urlparse
+from urllib.parse import urljoin
 from selenium.webdriver.common.by import By
 from urllib.request import Request, urlopen
 from selenium.webdriver.common.keys import Keys
@@ -18,24 +27,107 @@ from selenium.webdriver.common.action_chains import ActionChains
 from selenium.common.exceptions import NoSuchElementException, TimeoutException
 
 
+# Pulls the href value out of every <a> tag without building a DOM
+HREF_RE = re.compile(rb'<a\b[^>]*?\bhref\s*=\s*["\']([^"\']+)["\']', re.I)
+
+# Absolute links we keep; a tuple lets str.startswith check both in one call
+_HTTP_PREFIXES = ("http:", "https:")
+
+# An absolute http(s) URL with no whitespace, quotes or angle brackets
+_URL_RE = re.compile(r'https?://[^\s<>"\']+', re.I)     # used with fullmatch; '$' would allow a trailing newline
+
+
+# Pages are handed to lxml as UTF-8 bytes; fixing the encoding here overrides any <?xml encoding=...?> declaration in the source
+_LXML_PARSER = lxml_html.HTMLParser(encoding='utf-8')
+
+
+@functools.lru_cache(maxsize=8192)
+def _is_url(s: str) -> bool:
+    # The same hrefs (logos, navigation, footers) repeat across pages, so results are cached
+    return _URL_RE.fullmatch(s) is not None
+
+
 class Spider():
-    def __init__(self, root_string=""):
+    # Idle Chrome drivers handed back by closed spiders, keyed by whether they load images and CSS;
+    # booting a new browser is the slowest part of creating a Spider
+    _driver_pool: 'dict[bool, list[WebDriver]]' = {False: [], True: []}
+
+    # Maximum number of page sources each Spider keeps in its page cache
+    PAGE_CACHE_SIZE = 128
+
+    def __init__(self, root_string="", load_images=False):
         """ Initiation method for every 'Crawler' object.
 
         Args:
             root_string (str, optional): Initial link for a page to be crawled. Defaults to "".
+            load_images (bool, optional): Whether the browser downloads images and stylesheets. Link extraction does not need them,
+                so they are blocked by default; use a Spider with load_images=True to extract images. Defaults to False.
         """
         self.root = root_string
+        self.load_images = load_images
         self.response = None
+        self._last_url = None               # Last webpage loaded by the driver, kept here to avoid asking the driver for current_url
+        self._page_cache: 'dict[str, str]' = OrderedDict()  # Page sources of crawled webpages, least recently used first
         self.selenium_driver = self.__init_selenium_process__()
 
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __del__(self):
+        # Only shut the browser down here; pooling (which talks to the driver) is left to an explicit close()
+        driver = getattr(self, 'selenium_driver', None)
+        if driver is not None:
+            try:
+                driver.quit()
+            except Exception:
+                pass
+
+    def close(self):
+        """ Method that hands the Spider's Selenium driver back to the shared pool, so the next Spider can reuse the browser instead of starting a new one.
+        The driver is reset (cookies cleared, blank page loaded) before it is pooled; if that fails the driver is shut down instead.
+        """
+        driver = getattr(self, 'selenium_driver', None)
+        if driver is None:
+            return
+        self.selenium_driver = None
+
+        try:
+            driver.delete_all_cookies()
+            driver.get("about:blank")
+        except Exception:
+            driver.quit()
+            return
+        Spider._driver_pool[self.load_images].append(driver)
+
+    @classmethod
+    def quit_pooled_drivers(cls):
+        """ Method that shuts down every idle Chrome driver kept in the pool. It is also run when the program exits.
+        """
+        for pool in cls._driver_pool.values():
+            while pool:
+                pool.pop().quit()
+
     def __init_selenium_process__(self):
+        # Reuse an idle driver from a previously closed Spider when there is one
+        if Spider._driver_pool[self.load_images]:
+            return Spider._driver_pool[self.load_images].pop()
+
         # Start a Selenium driver; hide all information displayed
         op = Options()
         op.add_argument("--start-maximized")
         op.add_argument("--log-level=3")                                    # Disable any logging to the console
         op.add_argument("--headless=new")                                   # Run everything in the background
         op.add_experimental_option('excludeSwitches',['enable-logging'])    # Disables any residual logging to the console
+        if not self.load_images:
+            # Links do not need the rendered page; skip downloading images and stylesheets
+            op.add_experimental_option("prefs", {
+                "profile.managed_default_content_settings.images": 2,
+                "profile.managed_default_content_settings.stylesheets": 2
+            })
+            op.add_argument("--blink-settings=imagesEnabled=false")
         driver = webdriver.Chrome(options=op)
         driver.set_page_load_timeout(60) # set page load timeout to 30 seconds.
         return driver
@@ -70,11 +162,38 @@ class Spider():
 
         # if our current crawler has already crawled this page, and is set to that, reuse it, otherwise crawl.
 
-        if self.selenium_driver.current_url != webpage_url:
+        if webpage_url != self._last_url:
             try:
                 self.selenium_driver.get(webpage_url)
             except Exception as ex:
                 return ex
+            self._last_url = webpage_url
+
+    def _get_page_source(self, webpage: str = "") -> str:
+        """ Method that returns the HTML source of a webpage, reusing the cached source of a page that has already been crawled instead of loading it again.
+        Without a webpage, the source of the driver's current (possibly scrolled) state is returned and nothing is cached.
+
+        Args:
+            webpage (str, optional): Webpage URL to Crawl. Defaults to "".
+
+        Returns:
+            str: HTML source of the webpage, or an empty string if it could not be loaded.
+        """
+        if webpage == "":
+            return self.selenium_driver.page_source
+
+        if webpage in self._page_cache:
+            self._page_cache.move_to_end(webpage)
+            return self._page_cache[webpage]
+
+        if self.__optimize_selenium_driver__(webpage) is not None:
+            return ""       # The page failed to load; the driver still holds the previous page, which must not be cached under this URL
+        source = self.selenium_driver.page_source
+
+        self._page_cache[webpage] = source
+        if len(self._page_cache) > self.PAGE_CACHE_SIZE:
+            self._page_cache.popitem(last=False)
+        return source
 
     def get_all_sublinks_selenium_by_soup(self, webpage: str = "") -> 'set[str]':
         """ Method that utilizes the Selenium Driver to retrieve the links on a webpage. This method can be used as a backup or the main way to get links.
@@ -86,49 +205,88 @@ class Spider():
         Returns:
             temp_set (set): Set of links in a webpage.
         """
-        temp_set = set()
-
-        if webpage != "":
-            self.__optimize_selenium_driver__(webpage)
-
         waiting_time = 3
         _ = self.selenium_driver.timeouts.implicit_wait(waiting_time)
-        soup = BeautifulSoup(self.selenium_driver.page_source, 'html.parser')          # Utilize beautiful soup for speed.
+        page_source = self._get_page_source(webpage)
+        strainer = SoupStrainer('a', href=True)                             # Only build the <a href> elements, skip the rest of the DOM
+        soup = BeautifulSoup(page_source, 'lxml', parse_only=strainer)    # Utilize beautiful soup (lxml parser) for speed.
+
+        # Clean and filter every link in one pass over the strained tree (which only holds <a href> tags, possibly nested).
+        # Skip a link if it's broken, a mailto link, or more of an appended (#resources) link.
+        root = self.root
+        return {clean_href for a_tag in soup.find_all('a', href=True)
+                if (href := a_tag.get('href'))
+                and (clean_href := self.modify_verify_url(root, href)).startswith(_HTTP_PREFIXES)
+                and "mailto" not in clean_href}
+
+    def get_all_sublinks_fast(self, webpage: str = "") -> 'set[str]':
+        """ Method that scans the Selenium Driver's page source with a regex to retrieve the links on a webpage, skipping the DOM parse entirely.
+            If the regex yields no valid links (unusual markup), it falls back to the BeautifulSoup method above.
+
+        Args:
+            webpage_url (str, Optional): Webpage URL to Crawl
+
+        Returns:
+            temp_set (set): Set of links in a webpage.
+        """
+        page_source = self._get_page_source(webpage)
+        if page_source == "":       # The page failed to load; falling back would only retry the same failing load
+            return set()
+
+        hrefs = HREF_RE.findall(page_source.encode('utf-8', 'replace'))
+
+        # Decode entities (&amp;) and resolve relative links the same way the soup path does
+        root = self.root
+        links = {clean_href for h in hrefs
+                 if (clean_href := self.modify_verify_url(root, html.unescape(h.decode('utf-8', 'replace')))).startswith(_HTTP_PREFIXES)
+                 and "mailto" not in clean_href}
+        if not links:
+            return self.get_all_sublinks_selenium_by_soup(webpage)
+
+        return links
+
+    def get_all_sublinks_http(self, webpage: str) -> 'set[str]':
+        """ Method that retrieves the links on a webpage with a plain HTTP request, without going through the browser.
+            This method is set for static pages; if the request fails, or the page has no links but does have <script> tags (it is rendered in JS), it falls back to the Selenium Driver.
+
+        Args:
+            webpage (str): Webpage URL to Crawl
+
+        Returns:
+            temp_set (set): Set of links in a webpage.
+        """
+        self._start_request(webpage)
+        try:
+            with urlopen(self.response, timeout=60) as page:
+                content = page.read()
+        except (OSError, http.client.HTTPException):    # Refused (e.g. 403), missing, unreachable or cut off; the browser may still get through
+            return self.get_all_sublinks_selenium_by_soup(webpage)
+
+        soup = BeautifulSoup(content, 'lxml', parse_only=SoupStrainer('a', href=True))
         links = self.get_all_sublinks_from_soup(soup)
 
-        # record_start_time = perf_counter()
-        for l in links:
-            if l.startswith("https:") or l.startswith("http:"):          # Skip a link if it's more of an appended (#resources) link.
-                temp_set.add(l)
-        # record_end_time = perf_counter()
-        # perf_elapsed_time = record_end_time - record_start_time
-        # print(f"Looping through SOUP A TAGS executed in {perf_elapsed_time} seconds")
-        return temp_set
+        if not links and b'<script' in content.lower():
+            return self.get_all_sublinks_selenium_by_soup(webpage)
+
+        return {l for l in links if l.startswith(_HTTP_PREFIXES)}
 
     def get_all_sublinks_selenium_by_xpath(self, webpage: str = "") -> 'set[str]':
-        """ Same as the method above, just using the XPATH
-        
+        """ Same as the method above, but the links are read straight from the browser's DOM (equivalent to the XPATH //a[@href])
+
         Args:
             webpage_url (str, Optional): Webpage URL to Crawl
 
         Returns:
             temp_set (set): Set of links in a webpage.
         """
-        temp_set = set()
-
         if webpage != "":
             self.__optimize_selenium_driver__(webpage)
 
-        href_elements = self.selenium_driver.find_elements(By.XPATH, "//a[@href]")
-
-        # record_start_time = perf_counter()
-        for e in href_elements:
-            thing = e.get_attribute("href")
-            if thing.startswith("https:") or thing.startswith("http:"): 
-                temp_set.add(thing)
-        # record_end_time = perf_counter()
-        # print(f"Looping XPATH executed in {record_end_time - record_start_time} seconds")
-        return temp_set
+        # Fetch every (already absolute) href in a single script call, rather than one get_attribute round-trip per <a>
+        # document.links only holds HTML <a>/<area> elements; an <a> inside inline <svg> has a non-string href
+        hrefs = self.selenium_driver.execute_script(
+            "return Array.from(document.links, a => a.href).filter(h => typeof h === 'string');")
+        return {h for h in hrefs if isinstance(h, str) and h.startswith(_HTTP_PREFIXES)}
 
     # Code taken from https://www.thepythoncode.com/article/extract-all-website-links-python 
     # Modified by William E Basquez on 5/17/2023
@@ -141,39 +299,75 @@ class Spider():
       Returns:
           temp_set: Set of sublinks from a webpage.
       """
-      temp_set = set()
-      for a_tag in soup.find_all('a'):    # Find all the <a> tag elements
-          href = a_tag.get('href')        # Get all the href elements inside <a> tags
-          if href == "" or href is None:  # href empty tag
-              continue
-
-          clean_href = self.modify_verify_url(self.root, href)
-            
-          if clean_href != "" and "mailto" not in clean_href:
-              temp_set.add(clean_href)
-        
-      return temp_set
+      # Every <a> tag holding a non-empty href, turned into a valid URL; broken and mailto links are dropped
+      return {clean_href for a_tag in soup.find_all('a', href=True)
+              if (href := a_tag.get('href'))
+              and (clean_href := self.modify_verify_url(self.root, href))
+              and "mailto" not in clean_href}
+
+    def get_all_sublinks_lxml(self, page_source: str) -> 'set[str]':
+      """ Method that collects the sublinks of a webpage's HTML straight from lxml's tree, without wrapping every element in a BeautifulSoup Tag.
+      Relative links are made absolute against the root (or the page's <base href>). Use this over get_all_sublinks_from_soup when no soup is needed.
+
+      Args:
+          page_source (str): Webpage's HTML code
+
+      Returns:
+          temp_set: Set of sublinks from a webpage.
+      """
+      try:
+          doc = lxml_html.fromstring(page_source.encode('utf-8', 'replace'), parser=_LXML_PARSER)
+      except ParserError:     # Empty document
+          return set()
+      # Skip malformed links (e.g. http://[bad) rather than failing on the whole page
+      doc.make_links_absolute(self.root, resolve_base_href=True, handle_failures='discard')
+
+      # iterlinks also yields <img>, <script>, CSS links, etc.; only keep the href of <a> tags
+      return {link for element, attribute, link, _ in doc.iterlinks()
+              if element.tag == 'a' and attribute == 'href' and link.startswith(_HTTP_PREFIXES)}
 
     def get_all_images_from_soup(self, soup: BeautifulSoup) -> set:
       """ Method that takes in a HTML tree representation of a webpage and looks for all the <img> elements
 
       Args:
-          soup (BeautifulSoup): Webpage's tree structure of HTML code
+          soup (BeautifulSoup): Webpage's tree structure of HTML code, ideally built with parse_only=SoupStrainer('img')
+              from a Spider created with load_images=True
 
       Returns:
           temp_set: Set containing the text (alt) and URL of where an image is stored (src)
       """
       temp_set = set()
-      temp_links = []
+      seen_src = set()
       for a_tag in soup.find_all('img'):
-          if a_tag.get('src') not in temp_links:
-              temp_links.append(a_tag.get('src'))
-              temp_set.add((a_tag.get('alt'), a_tag.get('src')))
+          src = a_tag.get('src')
+          if src not in seen_src:
+              seen_src.add(src)
+              temp_set.add((a_tag.get('alt'), src))
       return temp_set
 
-    def modify_verify_url(self, root: str, url: str) -> str:
+    def get_all_images_selenium(self, webpage: str = "") -> 'set[tuple[str, str]]':
+        """ Method that utilizes the Selenium Driver to retrieve every image on a webpage in a single script call.
+            The source is the image's currentSrc, which resolves srcset and lazy-loaded images; this needs a Spider created with load_images=True.
+
+        Args:
+            webpage_url (str, Optional): Webpage URL to Crawl
+
+        Returns:
+            temp_set (set): Set containing the text (alt) and URL of where an image is stored (src)
+        """
+        if webpage != "":
+            self.__optimize_selenium_driver__(webpage)
+
+        pairs = self.selenium_driver.execute_script(
+            "return Array.from(document.images, i => [i.alt, i.currentSrc || i.src]);")
+        return {tuple(p) for p in pairs}
+
+    @staticmethod
+    @functools.lru_cache(maxsize=65536)
+    def modify_verify_url(root: str, url: str) -> str:
       """ Method that takes in a root URL and a potentially broken sublink within that root URL, and creates a new URL with the root's domain joined with the sublink.
       The method also checks if this new URL is a valid URL, if it is, then returns it; otherwise it returns an empty string (meaning the link is either broken or a misdirected link)
+      Results are cached, as the same links (navigation, footers, breadcrumbs) repeat within and across pages.
 
       Args:
           root (str): 'Main' page of a product
@@ -183,64 +377,43 @@ class Spider():
           str: String containing a valid URL, or an empty string
       """
 
-      # Clean the incoming link
-      if validators.url(url):
+      # Clean the incoming link; like browsers, ignore surrounding whitespace (e.g. a trailing newline) in the href
+      url = url.strip()
+      if _is_url(url):
           return url
         
-      clean_href = "".join(quote(i) for i in url)
+      # Quote the whole link in one call; reserved characters (and '%') are kept so already-encoded links stay the same
+      clean_href = quote(url, safe=":/?#[]@!$&'()*+,;=%")
 
-      if not validators.url(clean_href):  # if not a valid URL; make it valid
+      if not _is_url(clean_href):  # if not a valid URL; make it valid
           # join the URL if it's relative (not absolute link)
-          href = urljoin(root, clean_href)        
-          parsed_href = urlparse(href)
-        
-          # remove URL GET parameters, URL fragments, etc.
-          valid_href = parsed_href.scheme + "://" + parsed_href.netloc + parsed_href.path
-        
-          if validators.url(valid_href): # valid URL
+          href = urljoin(root, clean_href)
+
+          # remove URL fragments and GET parameters
+          valid_href = href.partition('#')[0].partition('?')[0]
+
+          if _is_url(valid_href): # valid URL
               return valid_href
       else:
-          return url
+          return clean_href
         
       return ""
 
-    def get_elements_xpaths(self, webpage: str, xpath: str) -> 'list[str]':
-        """_summary_
+    def get_elements_xpaths(self, webpage: str, xpath: str) -> 'list[WebElement]':
+        """ Method that finds every repeating element of a webpage in a single Selenium call.
 
         Args:
             webpage (str): URL of a 'main' product page
-            xpath (str): Full XPATH of an element within a webpage
+            xpath (str): Full XPATH of an element within a webpage, with [INDEX] in place of the repeating tag's index (e.g. /html/body/div[INDEX]/span)
 
         Returns:
-            list_of_paths: List of all the XPATHs of a repeating element type within a webpage
+            list_of_elements: List of all the WebElements of a repeating element type within a webpage
         """
-      
-        list_of_elements = []
-
-        path_of_elements = xpath.split('[INDEX]')
-
         self.__optimize_selenium_driver__(webpage)
-        
-        # We start with index at 1, because starting at 0 means tag is non-existent
-        index = 1
 
-        current_path = ""
-        while True:
-            # The assumption is that there will be at least 1 element, therefore we start with 1 inside square-brackets (div[1] == div; but div[2] != div)
-            current_path = path_of_elements[0] + '[' + str(index) + ']' + path_of_elements[1]
-
-            try:
-                element = self.selenium_driver.find_element(By.XPATH, current_path)
-            except NoSuchElementException:
-                pass
-
-            if element != None:  # If there is a WebElement with xpath = current_path, append its xpath
-                list_of_elements.append(element)
-                index += 1
-            else:           # If there is not a WebElement with xpath = current_path, stop search or do something else
-                break       # Maybe do somehting else...
-    
-        return list_of_elements
+        # Dropping the index makes the XPATH match every repetition of the element (div[1], div[2], ...) at once
+        base_xpath = xpath.replace('[INDEX]', '')
+        return self.selenium_driver.find_elements(By.XPATH, base_xpath)
 
     def get_attributes_from_selenium_using_xpath(self, xpath: str, attributes: 'list[str]') -> 'list[tuple[str,str]]':
         """Method that returns the attributes of a WebElement using Selenium.
@@ -271,11 +444,13 @@ class Spider():
         """
 
         self.__optimize_selenium_driver__(webpage)
+        self._page_cache.pop(webpage, None)     # Scrolling loads more content, so any cached source of this page is now stale
         time.sleep(2)
         start_y = 0
 
-        scroll_height = self.selenium_driver.execute_script("return document.body.scrollHeight") / 2
-        r = len(self.selenium_driver.execute_script("return window.performance.getEntries();"))
+        # Read the page height and the number of loaded resources together, one script call instead of two
+        page_state = "return [document.body.scrollHeight, window.performance.getEntries().length];"
+        scroll_height, r = self.selenium_driver.execute_script(page_state)
 
         counter = 1
         multiplier = 0
@@ -283,19 +458,62 @@ class Spider():
             counter /= 2
             multiplier += counter
 
-            scroll_height = self.selenium_driver.execute_script("return document.body.scrollHeight")
-
             scroll_dist = scroll_height * multiplier
 
             _ = self.selenium_driver.execute_script("window.scrollTo({}, {})".format(start_y, scroll_dist))
 
-            time.sleep(1)
-
-            q = len(self.selenium_driver.execute_script("return window.performance.getEntries();"))
-
-            if q == r:
+            # Wait only until new resources come in (up to 5 seconds); if none do, there is no more data to load
+            try:
+                state = WebDriverWait(self.selenium_driver, 5).until(
+                    lambda d: (page := d.execute_script(page_state))[1] != r and page)
+            except TimeoutException:
                 break
 
-            r = q
+            # The height read here is the one used for the next scroll
+            scroll_height, r = state
 
             start_y = scroll_dist
+
+
+# Idle pooled browsers would otherwise outlive the program
+atexit.register(Spider.quit_pooled_drivers)
+
+
+# Each crawl_many worker process keeps its own Spider (Selenium drivers are not thread-safe, so they are never shared)
+_worker_spider = None
+
+
+def _init_crawl_worker():
+    global _worker_spider
+    # A forked worker inherits the parent's idle pooled drivers; those browser sessions belong to the parent, so forget them
+    Spider._driver_pool = {False: [], True: []}
+    _worker_spider = Spider()
+
+    # Pool workers end through os._exit, so neither __del__ nor atexit fire; multiprocessing finalizers still do
+    Finalize(None, _worker_spider.selenium_driver.quit, exitpriority=10)
+
+
+def _crawl_worker(url: str) -> 'set[str]':
+    _worker_spider.root = url
+    try:
+        return _worker_spider.get_all_sublinks_selenium_by_xpath(url)
+    except Exception:       # One failing page should not discard the results of every other page
+        return set()
+
+
+def crawl_many(urls: 'list[str]', workers: int = 8) -> 'dict[str, set[str]]':
+    """ Function that crawls several webpages in parallel, one Spider (and browser) per worker process.
+
+    Args:
+        urls (list[str]): Webpage URLs to crawl
+        workers (int, optional): Number of worker processes. Defaults to 8.
+
+    Returns:
+        dict[str, set[str]]: Mapping of each webpage URL to the set of links found on it (empty if the page could not be crawled).
+    """
+    if not urls:
+        return {}
+
+    # Every worker boots its own browser, so never start more workers than there are pages
+    with ProcessPoolExecutor(min(workers, len(urls)), initializer=_init_crawl_worker) as executor:
+        return dict(zip(urls, executor.map(_crawl_worker, urls)))